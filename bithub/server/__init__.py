@@ -0,0 +1,9 @@
+from bithub.server.client import QuantizationClient, connect
+from bithub.server.server import QuantizationServer, serve
+
+__all__ = [
+    "QuantizationClient",
+    "QuantizationServer",
+    "connect",
+    "serve",
+]
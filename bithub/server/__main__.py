@@ -0,0 +1,61 @@
+# %%
+import argparse
+
+from bithub.server.server import serve
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve the bithub quantizers and scalers from a warm process"
+    )
+    parser.add_argument("--unix", default=None, help="Path of the Unix socket")
+    parser.add_argument("--host", default="127.0.0.1", help="TCP host")
+    parser.add_argument("--port", type=int, default=0, help="TCP port")
+    parser.add_argument(
+        "--backend",
+        action="append",
+        choices=["fxpmath", "xilinx"],
+        help="Quantizer backend to load, can be repeated (default: fxpmath)",
+    )
+    parser.add_argument(
+        "--scaler",
+        action="append",
+        default=[],
+        metavar="NAME=FILE",
+        help="BitScaler saved with BitScaler.save, can be repeated",
+    )
+    parser.add_argument(
+        "--warmup",
+        action="append",
+        default=[],
+        metavar="TYPE",
+        help='Type to compile before serving, e.g. "ap_fixed<8,3>", can be repeated',
+    )
+    parser.add_argument(
+        "--batch-window",
+        type=float,
+        default=0.0,
+        help="Seconds to wait for other requests of the same type",
+    )
+    args = parser.parse_args()
+
+    scalers = {}
+    for scaler in args.scaler:
+        name, sep, filename = scaler.partition("=")
+        if not sep:
+            parser.error(f"Invalid scaler {scaler}, expected NAME=FILE")
+        scalers[name] = filename
+
+    serve(
+        path=args.unix,
+        host=args.host,
+        port=args.port,
+        backends=args.backend or ["fxpmath"],
+        scalers=scalers,
+        warmup=args.warmup,
+        batch_window=args.batch_window,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# %%
+import asyncio
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from bithub.server.protocol import decode_array, encode_array, read_frame, write_frame
+
+
+class QuantizationClient:
+    """
+    Async client for a QuantizationServer. A single connection can be shared by
+    many concurrent tasks, the responses are matched to the requests by id.
+    Methods:
+    - connect(path=None, host="127.0.0.1", port=None): Open a connection to a server.
+    - quantize(x, ap_type, backend="fxpmath", convert="double"): Quantize an array on the server.
+    - scale(df, scaler): Apply a BitScaler loaded on the server.
+    - close(): Close the connection.
+    """
+
+    def __init__(self, reader, writer) -> None:
+        self._reader = reader
+        self._writer = writer
+        self._ids = itertools.count()
+        self._pending = {}
+        self._reader_task = asyncio.create_task(self._read_responses())
+
+    @classmethod
+    async def connect(cls, path=None, host="127.0.0.1", port=None):
+        """
+        Open a connection to a server.
+
+        Args:
+            path (str, optional): Path of the Unix socket. If not provided, the TCP host and port are used. Defaults to None.
+            host (str, optional): The TCP host. Defaults to "127.0.0.1".
+            port (int, optional): The TCP port. Defaults to None.
+
+        Returns:
+            QuantizationClient: The connected client.
+        """
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def _read_responses(self):
+        error = ConnectionError("Client closed")
+        try:
+            while True:
+                header, payload = await read_frame(self._reader)
+                future = self._pending.pop(header["id"], None)
+                if future is None or future.done():
+                    continue
+                if "error" in header:
+                    future.set_exception(ValueError(header["error"]))
+                    continue
+                try:
+                    # bytearray keeps the result writable, like the local quantizers
+                    future.set_result(decode_array(header, bytearray(payload)))
+                except Exception as e:
+                    future.set_exception(ValueError(f"Invalid response from the server: {e}"))
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            error = ConnectionError(f"Connection to the server lost: {e}")
+        except Exception as e:
+            error = ConnectionError(f"Invalid response from the server: {e}")
+        finally:
+            # also on cancellation, no request is left waiting for a response
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self._pending.clear()
+
+    async def _request(self, header, arr):
+        if self._reader_task.done():
+            raise ConnectionError("Client not connected")
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        array_header, buffer = encode_array(arr)
+        write_frame(self._writer, {"id": request_id, **header, **array_header}, buffer)
+        await self._writer.drain()
+        return await future
+
+    async def quantize(self, x, ap_type, backend="fxpmath", convert="double"):
+        """
+        Quantize an array on the server.
+
+        Args:
+            x (array-like): The values to quantize.
+            ap_type (str): The type, e.g. "ap_fixed<8,3,AP_TRN,AP_SAT>".
+            backend (str, optional): "fxpmath" or "xilinx", must be loaded by the server. Defaults to "fxpmath".
+            convert (str, optional): The output type, among "double", "float" and "int". Defaults to "double".
+
+        Returns:
+            numpy.ndarray: The quantized values, with the shape of x.
+
+        Raises:
+            ValueError: If the server could not quantize the values.
+        """
+        header = {
+            "op": "quantize",
+            "backend": backend,
+            "ap_type": ap_type,
+            "convert": convert,
+        }
+        return await self._request(header, np.asarray(x, dtype=np.float64))
+
+    async def scale(self, df, scaler):
+        """
+        Apply a BitScaler loaded on the server.
+
+        Args:
+            df (pandas.DataFrame|dict): The columns to scale.
+            scaler (str): The name the scaler was loaded with by the server.
+
+        Returns:
+            pandas.DataFrame|dict: The scaled columns, with the same type as df.
+
+        Raises:
+            ValueError: If the server could not scale the values.
+        """
+        columns = list(df.keys())
+        arr = np.column_stack([np.asarray(df[col], dtype=np.float64) for col in columns])
+        res = await self._request({"op": "scale", "scaler": scaler, "columns": columns}, arr)
+        res = {col: res[:, idx] for idx, col in enumerate(columns)}
+        if isinstance(df, pd.DataFrame):
+            return pd.DataFrame(res, index=df.index)
+        return res
+
+    async def close(self):
+        self._reader_task.cancel()
+        try:
+            await self._reader_task
+        except asyncio.CancelledError:
+            pass
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+async def connect(path=None, host="127.0.0.1", port=None):
+    return await QuantizationClient.connect(path=path, host=host, port=port)
@@ -0,0 +1,75 @@
+# %%
+import json
+import re
+import struct
+
+import numpy as np
+
+# Every message is a frame: a fixed prefix with the sizes of the JSON header and
+# of the raw payload, followed by the header and the payload (a C-contiguous
+# numpy buffer described by the "dtype" and "shape" fields of the header).
+_prefix = struct.Struct("!IQ")
+
+_ap_type_re = re.compile(r"^\s*(ap_fixed|ap_ufixed|ap_int|ap_uint)\s*<([^<>]*)>\s*$")
+_ap_mode_re = re.compile(r"^AP_[A-Z_]+$")
+
+_numeric_converts = ("double", "float", "int")
+
+
+def parse_ap_type(ap_type):
+    """
+    Parse a type string like "ap_fixed<8,3,AP_TRN,AP_SAT>" into the name of the
+    quantizer factory and its arguments, without evaluating the string.
+    """
+    match = _ap_type_re.match(ap_type)
+    if match is None:
+        raise ValueError(f"Type {ap_type} not supported")
+    name, args = match.groups()
+    parsed = []
+    for arg in args.split(","):
+        arg = arg.strip()
+        if arg.isdigit():
+            parsed.append(int(arg))
+        elif _ap_mode_re.match(arg):
+            parsed.append(arg)
+        else:
+            raise ValueError(f"Invalid argument {arg} in type {ap_type}")
+    return name, tuple(parsed)
+
+
+def check_convert(convert):
+    if convert not in _numeric_converts:
+        raise ValueError(
+            f"Conversion {convert} not supported, use one of {_numeric_converts}"
+        )
+    return convert
+
+
+def encode_array(arr):
+    # np.require keeps 0-d arrays, np.ascontiguousarray would make them 1-d
+    arr = np.require(arr, requirements="C")
+    return {"dtype": arr.dtype.str, "shape": list(arr.shape)}, memoryview(arr).cast("B")
+
+
+def decode_array(header, payload):
+    return np.frombuffer(payload, dtype=np.dtype(header["dtype"])).reshape(
+        header["shape"]
+    )
+
+
+async def read_frame(reader):
+    prefix = await reader.readexactly(_prefix.size)
+    header_size, payload_size = _prefix.unpack(prefix)
+    header = json.loads(await reader.readexactly(header_size))
+    payload = await reader.readexactly(payload_size) if payload_size else b""
+    return header, payload
+
+
+def write_frame(writer, header, payload=b""):
+    header = json.dumps(header).encode()
+    buffers = [_prefix.pack(len(header), len(payload)), header]
+    # Python 3.12 selector transports spin forever on empty buffers in writelines
+    if len(payload):
+        buffers.append(payload)
+    # a single writelines call keeps frames of concurrent tasks from interleaving
+    writer.writelines(buffers)
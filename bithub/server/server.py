@@ -0,0 +1,323 @@
+# %%
+import asyncio
+import importlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from bithub.scalers import BitScaler
+from bithub.server.protocol import (
+    check_convert,
+    decode_array,
+    encode_array,
+    parse_ap_type,
+    read_frame,
+    write_frame,
+)
+
+logger = logging.getLogger(__name__)
+
+_backends = ("fxpmath", "xilinx")
+
+
+class _Batch:
+    def __init__(self):
+        self.arrays = []
+        self.futures = []
+        self.size = 0
+        self.handle = None
+
+
+class QuantizationServer:
+    """
+    An asyncio server that keeps the quantization backends and the BitScaler
+    instances loaded in a single process and serves them on a Unix or TCP socket.
+    Concurrent requests for the same type (or the same scaler) are grouped in
+    micro-batches and evaluated with a single call to the backend.
+    Methods:
+    - start(path=None, host="127.0.0.1", port=0): Load the backends and start listening.
+    - serve_forever(): Serve the clients until the server is closed.
+    - close(): Stop the server and release the worker thread.
+    """
+
+    def __init__(
+        self,
+        backends=("fxpmath",),
+        scalers=None,
+        warmup=(),
+        batch_window=0.0,
+        max_batch_size=1 << 16,
+    ) -> None:
+        """
+        Initializes the QuantizationServer object.
+
+        Args:
+            backends (tuple, optional): The quantizer modules to keep loaded, among "fxpmath" and "xilinx". Defaults to ("fxpmath",).
+            scalers (dict, optional): A dictionary mapping a name to a fitted BitScaler or to the file it was saved to. Defaults to None.
+            warmup (tuple, optional): Types (e.g. "ap_fixed<8,3>") to compile on every backend before serving. Defaults to ().
+            batch_window (float, optional): Seconds to wait for other requests before evaluating a batch. With 0, the requests received in the same loop iteration or while the worker is busy are grouped. Defaults to 0.
+            max_batch_size (int, optional): Number of rows that triggers the evaluation of a batch before the window expires. Defaults to 65536.
+        """
+        for backend in backends:
+            if backend not in _backends:
+                raise ValueError(f"Backend {backend} not supported")
+        self.backend_names = tuple(backends)
+        self.scalers = {}
+        for name, scaler in (scalers or {}).items():
+            if not isinstance(scaler, BitScaler):
+                filename, scaler = scaler, BitScaler()
+                scaler.load(filename)
+            self.scalers[name] = scaler
+        self.warmup = tuple(warmup)
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+
+        self._backends = {}
+        self._quantizers = {}
+        self._pending = {}
+        self._ready = []
+        self._running = 0
+        self._tasks = set()
+        self._connections = {}
+        # ROOT/cling is not thread safe: every backend call goes through one thread
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._server = None
+
+    def _load_backends(self):
+        for backend in self.backend_names:
+            self._backends[backend] = importlib.import_module(
+                f"bithub.quantizers.{backend}"
+            )
+        for backend in self.backend_names:
+            for ap_type in self.warmup:
+                self._quantize((backend, ap_type, "double"), np.zeros(1))
+
+    def _quantize(self, key, data):
+        backend, ap_type, convert = key
+        module = self._backends[backend]
+        quantizer = self._quantizers.get((backend, ap_type))
+        if quantizer is None:
+            name, args = parse_ap_type(ap_type)
+            quantizer = getattr(module, name)(*args)
+            self._quantizers[(backend, ap_type)] = quantizer
+        return np.asarray(module.convert(quantizer(data), convert))
+
+    def _scale(self, key, data):
+        name, columns = key
+        df = pd.DataFrame(data, columns=list(columns))
+        df = self.scalers[name].apply(df, copy=False)
+        return df[list(columns)].to_numpy(dtype=np.float64)
+
+    def _submit(self, func, key, arr):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.get((func, key))
+        if batch is None:
+            batch = self._pending[(func, key)] = _Batch()
+            batch.handle = loop.call_later(self.batch_window, self._flush, func, key)
+        batch.arrays.append(arr)
+        batch.futures.append(future)
+        batch.size += len(arr)
+        if batch.size >= self.max_batch_size:
+            batch.handle.cancel()
+            self._start(func, key)
+        return future
+
+    def _flush(self, func, key):
+        # while the worker is busy the batch keeps growing, it starts when the worker is free
+        if self._running:
+            self._ready.append((func, key))
+        else:
+            self._start(func, key)
+
+    def _start(self, func, key):
+        batch = self._pending.pop((func, key), None)
+        if batch is None:
+            return
+        # a batch started by max_batch_size may still be waiting for the worker,
+        # the next batch of the same key must wait for its own window
+        if (func, key) in self._ready:
+            self._ready.remove((func, key))
+        self._running += 1
+        task = asyncio.ensure_future(self._run_batch(func, key, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, func, key, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            data = np.concatenate(batch.arrays)
+            result = await loop.run_in_executor(self._executor, func, key, data)
+        except Exception as e:
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._running -= 1
+            ready, self._ready = self._ready, []
+            for func_key in ready:
+                self._start(*func_key)
+        offsets = np.cumsum([len(arr) for arr in batch.arrays])[:-1]
+        for future, res in zip(batch.futures, np.split(result, offsets)):
+            if not future.done():
+                future.set_result(res)
+
+    async def _dispatch(self, header, payload):
+        op = header.get("op")
+        arr = decode_array(header, payload)
+        # validate each request on its own, a bad payload must not fail the whole batch
+        if arr.dtype.kind not in "biuf":
+            raise ValueError(f"Dtype {arr.dtype} not supported, only numeric values")
+        arr = arr.astype(np.float64, copy=False)
+        if op == "quantize":
+            backend = header["backend"]
+            if backend not in self._backends:
+                raise ValueError(f"Backend {backend} not loaded")
+            ap_type = header["ap_type"]
+            parse_ap_type(ap_type)
+            convert = check_convert(header.get("convert", "double"))
+            key = (backend, ap_type, convert)
+            if arr.size == 0:
+                # the backends fail on empty arrays: quantize one value to build the
+                # quantizer like any other request and to get the result dtype
+                res = await self._submit(self._quantize, key, np.zeros(1))
+                return res[:0].reshape(arr.shape)
+            res = await self._submit(self._quantize, key, arr.ravel())
+            return res.reshape(arr.shape)
+        elif op == "scale":
+            name = header["scaler"]
+            if name not in self.scalers:
+                raise ValueError(f"Scaler {name} not loaded")
+            columns = tuple(header["columns"])
+            if arr.ndim != 2 or arr.shape[1] != len(columns):
+                raise ValueError(f"Shape {arr.shape} does not match columns {columns}")
+            return await self._submit(self._scale, (name, columns), arr)
+        else:
+            raise ValueError(f"Operation {op} not supported")
+
+    async def _handle_request(self, writer, header, payload):
+        response = {"id": None}
+        try:
+            if not isinstance(header, dict):
+                raise ValueError(f"Header must be a JSON object, not {type(header).__name__}")
+            response["id"] = header.get("id")
+            result = await self._dispatch(header, payload)
+        except Exception as e:
+            response["error"] = f"{type(e).__name__}: {e}"
+            write_frame(writer, response)
+        else:
+            array_header, buffer = encode_array(result)
+            response.update(array_header)
+            write_frame(writer, response, buffer)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def _handle_connection(self, reader, writer):
+        tasks = set()
+        self._connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                try:
+                    header, payload = await read_frame(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except ValueError as e:
+                    # the frame boundaries cannot be trusted anymore, drop the client
+                    logger.warning("Closing connection after an invalid frame: %s", e)
+                    break
+                task = asyncio.create_task(
+                    self._handle_request(writer, header, payload)
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            self._connections.pop(writer, None)
+            writer.close()
+
+    async def start(self, path=None, host="127.0.0.1", port=0):
+        """
+        Load the backends and the warmup types, then start listening.
+
+        Args:
+            path (str, optional): Path of the Unix socket. If not provided, a TCP socket is used. Defaults to None.
+            host (str, optional): The TCP host. Defaults to "127.0.0.1".
+            port (int, optional): The TCP port, 0 picks a free one. Defaults to 0.
+
+        Returns:
+            QuantizationServer: The server itself.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._load_backends)
+        if path is not None:
+            self._server = await asyncio.start_unix_server(
+                self._handle_connection, path=path
+            )
+        else:
+            self._server = await asyncio.start_server(
+                self._handle_connection, host=host, port=port
+            )
+        return self
+
+    @property
+    def address(self):
+        if self._server is None:
+            raise ValueError("Server not started")
+        return self._server.sockets[0].getsockname()
+
+    async def serve_forever(self):
+        if self._server is None:
+            raise ValueError("Server not started")
+        await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            # since Python 3.12.1 wait_closed also waits for the clients to disconnect
+            for writer in self._connections:
+                writer.close()
+        for batch in self._pending.values():
+            batch.handle.cancel()
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(ConnectionError("Server closed"))
+        self._pending.clear()
+        self._ready.clear()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._connections:
+            await asyncio.gather(*self._connections.values(), return_exceptions=True)
+        if self._server is not None:
+            await self._server.wait_closed()
+            self._server = None
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+def serve(path=None, host="127.0.0.1", port=0, **kwargs):
+    """
+    Run a QuantizationServer until interrupted. The keyword arguments are passed
+    to the QuantizationServer constructor.
+    """
+
+    async def main():
+        async with QuantizationServer(**kwargs) as server:
+            await server.start(path=path, host=host, port=port)
+            print(f"Serving on {server.address}")
+            await server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,421 @@
+from bithub.quantizers import fxpmath
+from bithub.scalers import BitScaler
+from bithub.server import QuantizationClient, QuantizationServer
+from bithub.server.protocol import encode_array, read_frame, write_frame
+
+import asyncio
+import struct
+import threading
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+import pytest
+x = np.linspace(-100,100,1000)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def _patch_quantize(side_effect=None):
+    quantize = QuantizationServer._quantize
+
+    def wrapper(self, key, data):
+        if side_effect is not None:
+            side_effect(key, data)
+        return quantize(self, key, data)
+
+    return patch.object(QuantizationServer, "_quantize", autospec=True, side_effect=wrapper)
+
+
+def _call_sizes(mock):
+    return [len(call.args[2]) for call in mock.call_args_list]
+
+
+async def _quantize_concurrently(server, chunks, ap_type, convert):
+    await server.start()
+    host, port = server.address[:2]
+    async with await QuantizationClient.connect(host=host, port=port) as client:
+        return await asyncio.gather(
+            *[client.quantize(chunk, ap_type, convert=convert) for chunk in chunks]
+        )
+
+
+@pytest.mark.parametrize("ap_type, factory", [
+    ("ap_fixed<8,3>", lambda: fxpmath.ap_fixed(8, 3)),
+    ("ap_ufixed<12,6,AP_TRN,AP_WRAP>", lambda: fxpmath.ap_ufixed(12, 6, "AP_TRN", "AP_WRAP")),
+    ("ap_int<8>", lambda: fxpmath.ap_int(8)),
+])
+def test_server_quantize(ap_type, factory):
+    convert = "int" if "int" in ap_type else "double"
+    chunks = np.array_split(x, 10)
+
+    async def main():
+        async with QuantizationServer(batch_window=1e-2) as server:
+            return await _quantize_concurrently(server, chunks, ap_type, convert)
+
+    with _patch_quantize() as mock:
+        res = run(main())
+    expected = fxpmath.convert(factory()(x), convert)
+    np.testing.assert_equal(np.concatenate(res), expected)
+    #all the concurrent requests are served by a single backend call
+    assert _call_sizes(mock) == [len(x)]
+
+
+def test_server_batch_while_busy():
+    chunks = np.array_split(x, 10)
+    started = threading.Event()
+    release = threading.Event()
+
+    def block_first_call(key, data):
+        if not started.is_set():
+            started.set()
+            release.wait(5)
+
+    async def main():
+        #default window: requests received while the worker is busy are merged
+        async with QuantizationServer() as server:
+            await server.start()
+            host, port = server.address[:2]
+            async with await QuantizationClient.connect(host=host, port=port) as client:
+                first = asyncio.ensure_future(client.quantize(x, "ap_fixed<8,3>"))
+                await asyncio.to_thread(started.wait, 5)
+                queued = asyncio.gather(*[client.quantize(chunk, "ap_fixed<8,3>") for chunk in chunks])
+                await asyncio.sleep(0.1)
+                release.set()
+                return await first, await queued
+
+    with _patch_quantize(block_first_call) as mock:
+        first, queued = run(main())
+    expected = fxpmath.convert(fxpmath.ap_fixed(8, 3)(x), "double")
+    np.testing.assert_equal(first, expected)
+    np.testing.assert_equal(np.concatenate(queued), expected)
+    assert _call_sizes(mock) == [len(x), len(x)]
+
+
+def test_server_max_batch_size():
+    chunks = np.array_split(x, 4)
+
+    async def main():
+        #the window never expires, the batches start when they reach max_batch_size
+        async with QuantizationServer(batch_window=60, max_batch_size=len(x) // 2) as server:
+            return await asyncio.wait_for(_quantize_concurrently(server, chunks, "ap_fixed<8,3>", "double"), 5)
+
+    with _patch_quantize() as mock:
+        res = run(main())
+    np.testing.assert_equal(np.concatenate(res), fxpmath.convert(fxpmath.ap_fixed(8, 3)(x), "double"))
+    assert _call_sizes(mock) == [len(x) // 2, len(x) // 2]
+
+
+def test_server_max_batch_size_while_busy():
+    chunks = np.array_split(x, 10)
+    started = threading.Event()
+    release = threading.Event()
+
+    def block(key, data):
+        if key[1] == "ap_fixed<8,4>":
+            started.set()
+            release.wait(5)
+
+    async def main():
+        async with QuantizationServer(batch_window=0.5, max_batch_size=2 * len(chunks[0])) as server:
+            await server.start()
+            host, port = server.address[:2]
+            async with await QuantizationClient.connect(host=host, port=port) as client:
+                def send(chunk):
+                    return asyncio.ensure_future(client.quantize(chunk, "ap_fixed<8,3>"))
+
+                busy = asyncio.ensure_future(client.quantize(chunks[0], "ap_fixed<8,4>"))
+                await asyncio.to_thread(started.wait, 5)
+                #the window of the first batch expires while the worker is busy
+                requests = [send(chunks[0])]
+                await asyncio.sleep(0.75)
+                #max_batch_size starts it, then a new batch begins its own window
+                requests.append(send(chunks[1]))
+                await asyncio.sleep(0.05)
+                requests.append(send(chunks[2]))
+                await asyncio.sleep(0.05)
+                release.set()
+                await busy
+                requests.append(send(chunks[3]))
+                return await asyncio.gather(*requests)
+
+    with _patch_quantize(block) as mock:
+        res = run(main())
+    np.testing.assert_equal(np.concatenate(res), fxpmath.convert(fxpmath.ap_fixed(8, 3)(np.concatenate(chunks[:4])), "double"))
+    assert _call_sizes(mock) == [len(chunks[0])] + [2 * len(chunks[0])] * 2
+
+
+def test_server_batch_failure():
+    def fail(key, data):
+        if key[1] == "ap_fixed<8,4>":
+            raise RuntimeError("backend failure")
+
+    async def main():
+        async with QuantizationServer(batch_window=1e-2) as server:
+            await server.start()
+            host, port = server.address[:2]
+            async with await QuantizationClient.connect(host=host, port=port) as bad, \
+                    await QuantizationClient.connect(host=host, port=port) as good:
+                failed, res = await asyncio.gather(
+                    bad.quantize(x, "ap_fixed<8,4>"),
+                    good.quantize(x, "ap_fixed<8,3>"),
+                    return_exceptions=True,
+                )
+                #the failed connection is still usable
+                return failed, res, await bad.quantize(x, "ap_fixed<8,3>")
+
+    with _patch_quantize(fail):
+        failed, res, retry = run(main())
+    expected = fxpmath.convert(fxpmath.ap_fixed(8, 3)(x), "double")
+    assert isinstance(failed, ValueError)
+    np.testing.assert_equal(res, expected)
+    np.testing.assert_equal(retry, expected)
+
+
+@pytest.mark.parametrize("convert", ["double", "float", "int"])
+def test_server_xilinx(convert):
+    pytest.importorskip("ROOT")
+    from bithub.quantizers import xilinx
+
+    async def main():
+        async with QuantizationServer(backends=("xilinx",), warmup=("ap_fixed<8,3>",)) as server:
+            await server.start()
+            host, port = server.address[:2]
+            async with await QuantizationClient.connect(host=host, port=port) as client:
+                res = await asyncio.gather(
+                    *[client.quantize(chunk, "ap_fixed<8,3>", backend="xilinx", convert=convert) for chunk in np.array_split(x, 4)]
+                )
+                empty = await client.quantize([], "ap_fixed<8,3>", backend="xilinx", convert=convert)
+                return np.concatenate(res), empty
+
+    res, empty = run(main())
+    expected = xilinx.convert(xilinx.ap_fixed(8, 3)(x), convert)
+    np.testing.assert_equal(res, expected)
+    assert res.dtype == expected.dtype
+    assert empty.dtype == expected.dtype
+
+
+def test_server_errors():
+    async def main():
+        async with QuantizationServer() as server:
+            await server.start()
+            host, port = server.address[:2]
+            async with await QuantizationClient.connect(host=host, port=port) as client:
+                with pytest.raises(ValueError):
+                    await client.quantize(x, "ap_fixed<8,__import__>")
+                with pytest.raises(ValueError):
+                    await client.quantize(x, "ap_fixed<8,3>", backend="xilinx")
+                with pytest.raises(ValueError):
+                    await client.quantize(x, "ap_fixed<8,3>", convert="hex")
+                #the connection is still usable after an error
+                return await client.quantize(x, "ap_fixed<8,3>")
+
+    res = run(main())
+    np.testing.assert_equal(res, fxpmath.convert(fxpmath.ap_fixed(8, 3)(x), "double"))
+
+
+async def _raw_request(path, header, arr):
+    reader, writer = await asyncio.open_unix_connection(path)
+    array_header, buffer = encode_array(arr)
+    write_frame(writer, {"id": 0, **header, **array_header}, buffer)
+    await writer.drain()
+    response, _ = await read_frame(reader)
+    writer.close()
+    return response
+
+
+def test_server_bad_payload(tmp_path):
+    path = str(tmp_path / "bithub.sock")
+
+    async def main():
+        async with QuantizationServer(batch_window=1e-2) as server:
+            await server.start(path=path)
+            async with await QuantizationClient.connect(path=path) as client:
+                #a string payload from another connection only fails its own request
+                return await asyncio.gather(
+                    _raw_request(path, {"op": "quantize", "backend": "fxpmath", "ap_type": "ap_fixed<8,3>"}, np.array(["a"] * 10)),
+                    client.quantize(x, "ap_fixed<8,3>"),
+                )
+
+    response, res = run(main())
+    assert "error" in response
+    np.testing.assert_equal(res, fxpmath.convert(fxpmath.ap_fixed(8, 3)(x), "double"))
+
+
+@pytest.mark.parametrize("convert, dtype", [("double", np.float64), ("int", np.int64)])
+def test_server_empty(convert, dtype):
+    async def main():
+        async with QuantizationServer() as server:
+            await server.start()
+            host, port = server.address[:2]
+            async with await QuantizationClient.connect(host=host, port=port) as client:
+                return await client.quantize([], "ap_fixed<8,3>", convert=convert)
+
+    res = run(main())
+    assert res.shape == (0,)
+    assert res.dtype == dtype
+
+
+@pytest.mark.parametrize("ap_type", ["ap_fixed<8>", "ap_fixed<8,3,AP_RND>"])
+def test_server_empty_invalid_type(ap_type):
+    async def main():
+        async with QuantizationServer() as server:
+            await server.start()
+            host, port = server.address[:2]
+            async with await QuantizationClient.connect(host=host, port=port) as client:
+                #empty and non-empty requests accept the same types
+                for values in ([], x):
+                    with pytest.raises(ValueError):
+                        await client.quantize(values, ap_type)
+
+    run(main())
+
+
+def test_server_close():
+    started = threading.Event()
+    release = threading.Event()
+    finished = threading.Event()
+
+    def block(key, data):
+        if key[1] == "ap_fixed<8,4>":
+            started.set()
+            release.wait(5)
+            finished.set()
+
+    async def main():
+        async with QuantizationServer(batch_window=60, max_batch_size=len(x)) as server:
+            await server.start()
+            host, port = server.address[:2]
+            async with await QuantizationClient.connect(host=host, port=port) as client:
+                #started by max_batch_size, blocked in the worker
+                running = asyncio.ensure_future(client.quantize(x, "ap_fixed<8,4>"))
+                await asyncio.to_thread(started.wait, 5)
+                #waiting for a window that never expires
+                waiting = asyncio.ensure_future(client.quantize(x[:10], "ap_fixed<8,3>"))
+                await asyncio.sleep(0.1)
+                closing = asyncio.ensure_future(server.close())
+                await asyncio.sleep(0.1)
+                assert not closing.done()
+                release.set()
+                await asyncio.wait_for(closing, 5)
+                #close waits for the running batch before returning
+                assert finished.is_set()
+                return await asyncio.gather(running, waiting, return_exceptions=True)
+
+    with _patch_quantize(block) as mock:
+        results = run(main())
+    assert all(isinstance(res, ConnectionError) for res in results)
+    #the waiting batch is failed without reaching the backend
+    assert _call_sizes(mock) == [len(x)]
+
+
+def test_server_invalid_frames(tmp_path):
+    path = str(tmp_path / "bithub.sock")
+    errors = []
+
+    async def main():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        async with QuantizationServer() as server:
+            await server.start(path=path)
+            #a header that is not a JSON object gets an error response
+            reader, writer = await asyncio.open_unix_connection(path)
+            write_frame(writer, [1])
+            await writer.drain()
+            response, _ = await asyncio.wait_for(read_frame(reader), 5)
+            writer.close()
+            #a frame that is not valid JSON closes only its own connection
+            reader, writer = await asyncio.open_unix_connection(path)
+            writer.write(struct.pack("!IQ", 3, 0) + b"\xff{[")
+            await writer.drain()
+            eof = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            async with await QuantizationClient.connect(path=path) as client:
+                res = await client.quantize(x, "ap_fixed<8,3>")
+        return response, eof, res
+
+    response, eof, res = run(main())
+    assert response["id"] is None and "error" in response
+    assert eof == b""
+    np.testing.assert_equal(res, fxpmath.convert(fxpmath.ap_fixed(8, 3)(x), "double"))
+    assert errors == []
+
+
+def test_server_close_with_clients():
+    async def main():
+        server = QuantizationServer()
+        await server.start()
+        host, port = server.address[:2]
+        async with await QuantizationClient.connect(host=host, port=port) as client:
+            await client.quantize(x, "ap_fixed<8,3>")
+            #the connected client does not keep the server from closing
+            await asyncio.wait_for(server.close(), 5)
+            with pytest.raises(ConnectionError):
+                await asyncio.wait_for(client.quantize(x, "ap_fixed<8,3>"), 5)
+
+    run(main())
+
+
+def test_server_scalar():
+    async def main():
+        async with QuantizationServer() as server:
+            await server.start()
+            host, port = server.address[:2]
+            async with await QuantizationClient.connect(host=host, port=port) as client:
+                return await client.quantize(np.float64(3.3), "ap_fixed<8,3>")
+
+    res = run(main())
+    assert res.shape == ()
+    assert res == fxpmath.convert(fxpmath.ap_fixed(8, 3)(3.3), "double")
+
+
+def test_client_writable_result():
+    async def main():
+        async with QuantizationServer() as server:
+            await server.start()
+            host, port = server.address[:2]
+            async with await QuantizationClient.connect(host=host, port=port) as client:
+                return await client.quantize(x, "ap_fixed<8,3>")
+
+    res = run(main())
+    res[0] = 1
+    assert res[0] == 1
+
+
+@pytest.mark.parametrize("response", [{"no_id": 0}, {"id": 0, "dtype": "<f8", "shape": [3]}])
+def test_client_invalid_response(tmp_path, response):
+    path = str(tmp_path / "bithub.sock")
+
+    async def handler(reader, writer):
+        await read_frame(reader)
+        write_frame(writer, response)
+        await writer.drain()
+        await reader.read()
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_unix_server(handler, path=path)
+        async with server:
+            async with await QuantizationClient.connect(path=path) as client:
+                with pytest.raises((ValueError, ConnectionError)):
+                    await asyncio.wait_for(client.quantize(x, "ap_fixed<8,3>"), 5)
+
+    run(main())
+
+
+def test_server_scale(tmp_path):
+    df = pd.DataFrame({"a": x, "b": x * 3 + 1})
+    scaler = BitScaler()
+    scaler.fit(df)
+    scaler.save(tmp_path / "scaler.json")
+
+    async def main():
+        path = str(tmp_path / "bithub.sock")
+        async with QuantizationServer(scalers={"s": str(tmp_path / "scaler.json")}) as server:
+            await server.start(path=path)
+            async with await QuantizationClient.connect(path=path) as client:
+                return await asyncio.gather(client.scale(df[:500], "s"), client.scale(df[500:], "s"))
+
+    res = pd.concat(run(main()))
+    pd.testing.assert_frame_equal(res, scaler.apply(df), check_dtype=False)